@@ -15,8 +15,11 @@
 """Main pipeline code.
 """
 
+import concurrent.futures
 import datetime
-import urllib
+import functools
+import logging
+from urllib.parse import quote_plus
 
 from googleapiclient import discovery
 from googleapiclient.http import MediaFileUpload
@@ -24,11 +27,15 @@ import httplib2
 from oauth2client.service_account import ServiceAccountCredentials
 import params
 import requests
-from retrying import retry
+from requests.adapters import HTTPAdapter
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
+from tenacity import retry
+from tenacity import stop_after_attempt
+from tenacity import wait_random_exponential
 
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
 
 GA_ACCOUNT_ID = params.GA_ACCOUNT_ID
 GA_PROPERTY_ID = params.GA_PROPERTY_ID
@@ -36,6 +43,11 @@ GA_DATASET_ID = params.GA_DATASET_ID
 GA_IMPORT_METHOD = params.GA_IMPORT_METHOD
 BQML_PREDICT_QUERY = params.BQML_PREDICT_QUERY
 GA_MP_STANDARD_HIT_DETAILS = params.GA_MP_STANDARD_HIT_DETAILS
+# standard hit details with a value set, filtered once for all hits
+GA_MP_ACTIVE_HIT_DETAILS = {ga_key: value
+                            for (ga_key, value)
+                            in GA_MP_STANDARD_HIT_DETAILS.items()
+                            if value}
 
 ENABLED_LOGGING = params.ENABLE_BQ_LOGGING
 ENABLED_EMAIL = params.ENABLE_SENDGRID_EMAIL_REPORTING
@@ -52,8 +64,23 @@ HTML_CONTENT = params.HTML_CONTENT
 
 SERVICE_ACCOUNT_FILE = "svc_key.json"
 CSV_LOCATION = "/tmp/data.csv"
+GA_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# retries per chunk on transient errors, so a failed chunk resumes the upload
+GA_UPLOAD_NUM_RETRIES = 5
+# number of rows fetched from BQ per page when streaming MP results
+BQ_PAGE_SIZE = 10000
 
 GA_MP_ENDPOINT = "https://www.google-analytics.com/batch"
+# (connect, read) timeouts in seconds for each batch request
+GA_MP_TIMEOUT = (3, 10)
+# number of batch requests in flight at the same time
+GA_MP_MAX_WORKERS = 8
+# max number of batch requests queued or in flight before waiting on results
+GA_MP_MAX_PENDING = 32
+
+# Shared session so batch requests reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
 
 GA_SCOPES = ["https://www.googleapis.com/auth/analytics.readonly",
              "https://www.googleapis.com/auth/analytics.edit",
@@ -63,36 +90,73 @@ GA_API_VERSION = "v3"
 
 CLOUD_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
 
+# per-batch details are logged at DEBUG and skipped at the default INFO level
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 
+@functools.lru_cache(maxsize=1)
 def authorize_ga_api():
   """Fetches the GA API obj.
 
+  The API obj is cached so warm invocations reuse it.
+
   Returns:
     ga_api: GA API obj.
   """
   ga_credentials = ServiceAccountCredentials.from_json_keyfile_name(
       SERVICE_ACCOUNT_FILE, GA_SCOPES)
   http = ga_credentials.authorize(http=httplib2.Http())
-  ga_api = discovery.build(GA_API_NAME, GA_API_VERSION, http=http)
+  # use the discovery document bundled with the client library rather than
+  # fetching it over the network
+  ga_api = discovery.build(GA_API_NAME, GA_API_VERSION, http=http,
+                           static_discovery=True)
   return ga_api
 
 
+@functools.lru_cache(maxsize=1)
+def get_bq_client():
+  """Fetches the BQ client, cached so warm invocations reuse it.
+
+  Returns:
+    bq_client: BigQuery client.
+  """
+  return bigquery.Client()
+
+
+@functools.lru_cache(maxsize=1)
+def get_bqstorage_client():
+  """Fetches the BQ Storage read client, cached so warm invocations reuse it.
+
+  Returns:
+    bqstorage_client: BigQuery Storage read client.
+  """
+  return bigquery_storage.BigQueryReadClient()
+
+
 def read_from_bq():
   """Reads the prediction query from Bigquery using BQML.
 
   Returns:
-    dataframe: BQML model results dataframe.
+    dataframe: BQML model results dataframe. For the Measurement Protocol
+        an iterable of dataframes, one per result page, is returned instead.
   """
 
-  bq_client = bigquery.Client()
+  bq_client = get_bq_client()
   query_job = bq_client.query(BQML_PREDICT_QUERY)
+  if GA_IMPORT_METHOD == "mp":
+    # stream the results page by page so hits are sent while the rest of the
+    # results are still downloading
+    results = query_job.result(page_size=BQ_PAGE_SIZE)
+    bqstorage_client = get_bqstorage_client()
+    return results.to_dataframe_iterable(bqstorage_client=bqstorage_client)
   results = query_job.result()
-  dataframe = results.to_dataframe()
+  # download through the BQ Storage API as Arrow rather than paged JSON
+  dataframe = results.to_dataframe(bqstorage_client=get_bqstorage_client())
   if GA_IMPORT_METHOD == "di":
     # assumes columns in BQ are named as ga_<name> e.g. ga_dimension1
     # converts them to ga:clientId, ga:dimension1
-    dataframe.columns = [col_name.replace("_", ":")
-                         for col_name in dataframe.columns.values]
+    dataframe.columns = dataframe.columns.str.replace("_", ":", regex=False)
   return dataframe
 
 
@@ -102,9 +166,9 @@ def write_df_to_csv(df):
   Args:
     df: final results dataframe for GA export.
   """
-  csv_string = df.to_csv(index=False)
-  with open(CSV_LOCATION, "w+") as f:
-    f.write(csv_string)
+  # write straight to the file in blocks of rows rather than building the
+  # whole CSV string in memory first
+  df.to_csv(CSV_LOCATION, index=False, chunksize=100000)
 
 
 def write_to_ga_via_di(ga_api):
@@ -113,14 +177,20 @@ def write_to_ga_via_di(ga_api):
   Args:
     ga_api: Google Analytics Management API object.
   """
+  # resumable upload sends the file in chunks instead of reading it into
+  # memory in one go
   media = MediaFileUpload(CSV_LOCATION,
                           mimetype="application/octet-stream",
-                          resumable=False)
-  ga_api.management().uploads().uploadData(
+                          chunksize=GA_UPLOAD_CHUNK_SIZE,
+                          resumable=True)
+  upload_request = ga_api.management().uploads().uploadData(
       accountId=GA_ACCOUNT_ID,
       webPropertyId=GA_PROPERTY_ID,
       customDataSourceId=GA_DATASET_ID,
-      media_body=media).execute()
+      media_body=media)
+  response = None
+  while response is None:
+    _, response = upload_request.next_chunk(num_retries=GA_UPLOAD_NUM_RETRIES)
 
 
 def delete_ga_prev_uploads(ga_api):
@@ -135,6 +205,10 @@ def delete_ga_prev_uploads(ga_api):
       customDataSourceId=GA_DATASET_ID).execute()
   uploads = response["items"]
   cids = [upload["id"] for upload in uploads[1:]]
+  # the delete depends on the listed ids so it cannot share a batch request
+  # with the list call; skip the round trip when nothing needs deleting
+  if not cids:
+    return
   delete_request_body = {"customDataImportUids": cids}
   ga_api.management().uploads().deleteUploadData(
       accountId=GA_ACCOUNT_ID,
@@ -143,42 +217,39 @@ def delete_ga_prev_uploads(ga_api):
       body=delete_request_body).execute()
 
 
-def send_mp_hit(payload_send, success_requests, failed_requests):
+def send_mp_hit(payload_send):
   """Send hit to Measurement Protocol endpoint.
 
   Args:
       payload_send: Measurement Protocol hit package to send
-      success_requests: list of successful batch requests to GA
-      failed_requests:  list of failed batch requests to GA
   Returns:
       boolean
   """
 
-  # Submit a POST request to Measurement Protocol endpoint
-  prepared = requests.Request("POST",
-                              GA_MP_ENDPOINT,
-                              data=payload_send).prepare()
-  print("Sending measurement protcol request to url " + prepared.url)
-
-  response = requests.Session().send(prepared)
+  # Submit a POST request to Measurement Protocol endpoint, reusing the
+  # pooled connections of the module level session
+  logger.debug("Sending measurement protocol request to url %s",
+               GA_MP_ENDPOINT)
+  response = SESSION.post(GA_MP_ENDPOINT, data=payload_send,
+                          timeout=GA_MP_TIMEOUT)
 
-  if response.status_code not in range(200, 299):
-    print("Measurement Protocol submission unsuccessful status code: " +
-          str(response.status_code))
-    failed_requests.append(payload_send)
-    return success_requests, failed_requests
+  if not 200 <= response.status_code < 300:
+    logger.warning("Measurement Protocol submission unsuccessful status code: "
+                   "%s", response.status_code)
+    return False
 
-  print("Measurement Protocol submission status code: " +
-        str(response.status_code))
-  success_requests.append(payload_send)
-  return success_requests, failed_requests
+  logger.debug("Measurement Protocol submission status code: %s",
+               response.status_code)
+  return True
 
 
-def prepare_payloads_for_batch_request(payloads):
+def prepare_payloads_for_batch_request(payloads, keys=None):
   """Merges payloads to send them in a batch request.
 
   Args:
     payloads: list of payload, each payload being a dictionary.
+    keys: list of the keys shared by all payloads, in the order they are
+        encoded. Taken from the first payload if not provided.
 
   Returns:
     concatenated url-encoded payloads. For example:
@@ -186,83 +257,138 @@ def prepare_payloads_for_batch_request(payloads):
         param1=value11&param2=value21
   """
   assert isinstance(payloads, list) or isinstance(payloads, tuple)
-  payloads_utf8 = [sorted([(k, str(p[k]).encode("utf-8")) for k in p],
-                          key=lambda t: t[0]) for p in payloads]
-  return "\n".join(map(lambda p: urllib.parse.urlencode(p), payloads_utf8))
+  if not payloads:
+    return ""
+  # MP does not require the parameters in any particular order
+  if keys is None:
+    keys = list(payloads[0].keys())
+  # all payloads share the same keys, so the "key=" prefixes are encoded
+  # once per batch and only the values are quoted per hit
+  key_prefixes = [(k, quote_plus(k) + "=") for k in keys]
+  lines = ["&".join([prefix + quote_plus(str(p[k]))
+                     for (k, prefix) in key_prefixes])
+           for p in payloads]
+  return "\n".join(lines)
+
+
+def collect_mp_results(futures, pending_requests, success_requests,
+                       failed_requests):
+  """Records the outcome of completed Measurement Protocol batch requests.
+
+  Args:
+    futures: completed futures returned by send_mp_hit.
+    pending_requests: dict of in-flight futures to their payload. Collected
+        futures are removed from it.
+    success_requests: list of successful batch requests to GA
+    failed_requests:  list of failed batch requests to GA
+  """
+  for future in futures:
+    payload_send = pending_requests.pop(future)
+    try:
+      succeeded = future.result()
+    except requests.RequestException as e:
+      logger.warning("Measurement Protocol submission failed: %s", e)
+      succeeded = False
+    if succeeded:
+      success_requests.append(payload_send)
+    else:
+      failed_requests.append(payload_send)
 
 
-def write_to_ga_via_mp(df):
+def write_to_ga_via_mp(dataframes):
   """Write the prediction results into GA via Measurement Protocol.
 
   Args:
-    df: BQML model results dataframe
+    dataframes: iterable of BQML model results dataframes
   """
   i = 0
   success_requests, failed_requests, payload_list = list(), list(), list()
-
-  for row_index, bq_results_row in df.iterrows():
-    i += 1
-    hit_data = {}
-    for (ga_key, value) in GA_MP_STANDARD_HIT_DETAILS.items():
-      if value:
-        hit_data[ga_key] = value
-
-    # add additional information from BQ
-    for (column_name, column_value) in bq_results_row.iteritems():
-      hit_data[column_name] = column_value
-
-    payload_list.append(hit_data)
-
-    if i%20 == 0:
-      # batch the hits up
-      payload_send = prepare_payloads_for_batch_request(payload_list)
-      print("Payload to send: " + payload_send)
-      success_requests, failed_requests = send_mp_hit(payload_send,
-                                                      success_requests,
-                                                      failed_requests)
-      payload_list = list()
-      i = 0
-
-  # Issue last batch call
-  if i > 0:
-    print("Sending remaining items to GA")
-    payload_send = prepare_payloads_for_batch_request(payload_list)
-    print("Payload to send: " + payload_send)
-    success_requests, failed_requests = send_mp_hit(payload_send,
-                                                    success_requests,
-                                                    failed_requests)
-
-  print("Completed all GA calls. Total successful batches:  " +
-        str(len(success_requests)) + " and failed batches: " +
-        str(len(failed_requests)))
+  pending_requests = {}
+
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=GA_MP_MAX_WORKERS) as executor:
+    for df in dataframes:
+      columns = list(df.columns)
+      # BQ columns take precedence over the standard hit details, so only
+      # the details not already in the results are added to each row
+      standard_details = {ga_key: value
+                          for (ga_key, value)
+                          in GA_MP_ACTIVE_HIT_DETAILS.items()
+                          if ga_key not in columns}
+      hit_keys = columns + list(standard_details)
+      # to_dict builds all row dicts in one pass inside pandas
+      for hit_data in df.to_dict(orient="records"):
+        i += 1
+        hit_data.update(standard_details)
+
+        payload_list.append(hit_data)
+
+        if i%20 == 0:
+          # batch the hits up
+          payload_send = prepare_payloads_for_batch_request(payload_list,
+                                                            hit_keys)
+          logger.debug("Payload to send: %s", payload_send)
+          future = executor.submit(send_mp_hit, payload_send)
+          pending_requests[future] = payload_send
+          payload_list = list()
+          i = 0
+
+          # keep a bounded window of batches in flight so a large result
+          # set does not queue up every payload at once
+          if len(pending_requests) >= GA_MP_MAX_PENDING:
+            done, _ = concurrent.futures.wait(
+                pending_requests,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            collect_mp_results(done, pending_requests,
+                               success_requests, failed_requests)
+
+    # Issue last batch call
+    if i > 0:
+      logger.debug("Sending remaining items to GA")
+      payload_send = prepare_payloads_for_batch_request(payload_list,
+                                                        hit_keys)
+      logger.debug("Payload to send: %s", payload_send)
+      future = executor.submit(send_mp_hit, payload_send)
+      pending_requests[future] = payload_send
+
+    collect_mp_results(concurrent.futures.as_completed(pending_requests),
+                       pending_requests, success_requests, failed_requests)
+
+  logger.info("Completed all GA calls. Total successful batches: %d and "
+              "failed batches: %d", len(success_requests), len(failed_requests))
   if failed_requests:
-    print("Failed request details: " + failed_requests)
+    logger.error("Failed request details: %s", failed_requests)
 
 
-# Retry 2^x * 1000 milliseconds between each retry, up to 10 seconds
-# ,then 10 seconds afterwards - for 5 attempts
-@retry(stop_max_attempt_number=5,
-       wait_exponential_multiplier=1000, wait_exponential_max=10000)
+# Retry after a random wait of up to 2^x seconds, capped at 10 seconds
+# - for 5 attempts. The jitter keeps retries from concurrent runs apart.
+@retry(stop=stop_after_attempt(5),
+       wait=wait_random_exponential(multiplier=1, max=10),
+       reraise=True)
 def write_to_bq_logs(status, message):
   """Write to BQ Logs.
 
   Args:
     status: status of the workflow run - SUCCESS or ERROR
     message: Error message, if there's an error
+
+  Raises:
+    RuntimeError: An exception for rows rejected by BQ.
   """
-  bq_client = bigquery.Client()
+  bq_client = get_bq_client()
   timestamp_utc = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-  bq_insert_template_query = """INSERT INTO `{0}` VALUES ("{1}","{2}","{3}")"""
-  write_logs_query = bq_insert_template_query.format(LOGS_BQ_TABLE,
-                                                     timestamp_utc,
-                                                     status, message)
-  bq_client.query(write_logs_query)
-
-
-# Retry 2^x * 1000 milliseconds between each retry, up to 10 seconds
-# ,then 10 seconds afterwards - for 5 attempts
-@retry(stop_max_attempt_number=5,
-       wait_exponential_multiplier=1000, wait_exponential_max=10000)
+  # streaming insert avoids a DML query job and its table modification quota
+  log_rows = [{"time": timestamp_utc, "status": status, "error": message}]
+  errors = bq_client.insert_rows_json(LOGS_BQ_TABLE, log_rows)
+  if errors:
+    raise RuntimeError("Logs not written to BQ: {0}".format(errors))
+
+
+# Retry after a random wait of up to 2^x seconds, capped at 10 seconds
+# - for 5 attempts. The jitter keeps retries from concurrent runs apart.
+@retry(stop=stop_after_attempt(5),
+       wait=wait_random_exponential(multiplier=1, max=10),
+       reraise=True)
 def send_email(error_message):
   """Delete previous GA data import files.
 
@@ -317,4 +443,5 @@ def trigger_workflow(request):
     return message
 
 
-print(trigger_workflow(request=None))
+if __name__ == "__main__":
+  print(trigger_workflow(request=None))
@@ -38,6 +38,9 @@ MODEL_FILE_NAME = params.MODEL_FILE_NAME
 SERVICE_ACCOUNT_FILE = "svc_key.json"
 CLOUD_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
 CSV_LOCATION = "output.csv"
+GA_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# retries per chunk on transient errors, so a failed chunk resumes the upload
+GA_UPLOAD_NUM_RETRIES = 5
 GA_SCOPES = [
     "https://www.googleapis.com/auth/analytics.readonly",
     "https://www.googleapis.com/auth/analytics.edit",
@@ -84,9 +87,9 @@ def prepare_csv(df):
   Args:
     df: final results dataframe for GA export.
   """
-  csv_string = df.to_csv(index=False)
-  with open(CSV_LOCATION, "w+") as f:
-    f.write(csv_string)
+  # write straight to the file in blocks of rows rather than building the
+  # whole CSV string in memory first
+  df.to_csv(CSV_LOCATION, index=False, chunksize=100000)
 
 
 def write_to_ga_via_di(ga_api):
@@ -95,14 +98,20 @@ def write_to_ga_via_di(ga_api):
   Args:
     ga_api: Google Analytics Management API object.
   """
+  # resumable upload sends the file in chunks instead of reading it into
+  # memory in one go
   media = MediaFileUpload(CSV_LOCATION,
                           mimetype="application/octet-stream",
-                          resumable=False)
-  ga_api.management().uploads().uploadData(
+                          chunksize=GA_UPLOAD_CHUNK_SIZE,
+                          resumable=True)
+  upload_request = ga_api.management().uploads().uploadData(
       accountId=GA_ACCOUNT_ID,
       webPropertyId=GA_PROPERTY_ID,
       customDataSourceId=GA_DATASET_ID,
-      media_body=media).execute()
+      media_body=media)
+  response = None
+  while response is None:
+    _, response = upload_request.next_chunk(num_retries=GA_UPLOAD_NUM_RETRIES)
 
 
 def delete_ga_prev_uploads(ga_api):
@@ -117,6 +126,10 @@ def delete_ga_prev_uploads(ga_api):
       customDataSourceId=GA_DATASET_ID).execute()
   uploads = response["items"]
   cids = [upload["id"] for upload in uploads[1:]]
+  # the delete depends on the listed ids so it cannot share a batch request
+  # with the list call; skip the round trip when nothing needs deleting
+  if not cids:
+    return
   delete_request_body = {"customDataImportUids": cids}
   ga_api.management().uploads().deleteUploadData(
       accountId=GA_ACCOUNT_ID,
@@ -154,4 +167,5 @@ def main():
     print("{0},ERROR,{1}".format(timestamp_utc, str(e)))
 
 
-main()
+if __name__ == "__main__":
+  main()